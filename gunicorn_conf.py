@@ -0,0 +1,14 @@
+"""Production server settings: gunicorn -c gunicorn_conf.py main:app
+
+preload_app imports the app, and so loads the FAISS indexes, once in the master;
+forked workers then share those pages copy-on-write instead of each loading a copy.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", (2 * (os.cpu_count() or 1)) + 1))
+# Seen by the preloaded app, so per-process thread pools (ONNX embeddings) can size to their share
+os.environ["WEB_CONCURRENCY"] = str(workers)
+preload_app = True
+timeout = 120
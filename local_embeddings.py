@@ -0,0 +1,74 @@
+import os
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+MODEL_CACHE_DIR = "data/onnx_models"
+
+def default_intra_op_threads() -> int:
+    # Split the cores between gunicorn workers (gunicorn_conf exports WEB_CONCURRENCY)
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    return max(1, (os.cpu_count() or 1) // workers)
+
+class ONNXEmbeddings(Embeddings):
+    """Local sentence-transformer embeddings served by ONNX Runtime with INT8 dynamic quantization"""
+
+    def __init__(self, model_name: str = DEFAULT_MODEL, cache_dir: str = MODEL_CACHE_DIR, batch_size: int = 64):
+        try:
+            import onnxruntime as ort
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("EMBEDDINGS_BACKEND=onnx needs: pip install -r requirements-onnx.txt") from e
+
+        self.batch_size = batch_size
+        model_dir = os.path.join(cache_dir, model_name.replace("/", "__") + "-int8")
+        if not os.path.exists(model_dir):
+            self._export_quantized(model_name, model_dir)
+
+        # Intra-op threads run the matmuls that dominate inference; every worker process has its own pool
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = int(os.getenv("ONNX_INTRA_OP_THREADS", default_intra_op_threads()))
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name="model_quantized.onnx",
+            session_options=session_options,
+        )
+
+    @staticmethod
+    def _export_quantized(model_name: str, model_dir: str):
+        """Export the model to ONNX once and save an INT8 dynamically quantized copy"""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        print(f"Exporting {model_name} to quantized ONNX")
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+        quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors="np")
+            hidden = self.model(**inputs).last_hidden_state
+
+            # Mean pooling over real tokens, then L2 normalize
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+            vectors.extend(pooled.astype(np.float32).tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
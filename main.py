@@ -2,14 +2,35 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-from fastapi import FastAPI
+import asyncio
+import anyio.to_thread
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from models import QueryRequest, QueryResponse, PolicyGenerationRequest, PolicyGenerationResponse
 from policy_agent import generate_policy
-from rag_query import query_rag
+from rag_query import aquery_rag, stream_rag, warmup
 from metrics_api import router as metrics_router
 
-app = FastAPI(title="AI Policy Backend", version="1.0.0")
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "128"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sync routes and background tasks share anyio's default limiter, which allows 40 threads
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # asyncio.to_thread (retrieval, local embeddings, policy search) uses the loop's default
+    # executor instead, capped at min(32, cpu + 4) threads unless replaced
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREADPOOL_SIZE, thread_name_prefix="to-thread")
+    )
+    # Runs per worker after fork, in the background, so startup never waits on the network
+    warmup_task = asyncio.create_task(warmup())
+    yield
+    warmup_task.cancel()
+
+app = FastAPI(title="AI Policy Backend", version="1.0.0", lifespan=lifespan)
 
 default_origins = ["http://localhost:3000", "https://ai-policy.onrender.com", "https://policy-jylh.vercel.app"]
 env_origins = os.getenv("ALLOWED_ORIGINS")
@@ -27,18 +48,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/ask", response_model=QueryResponse)
-def ask(request: QueryRequest):
+def history_payload(request: QueryRequest):
     # Pass optional chat history through for follow-up awareness
-    history_payload = None
     if request.history:
-        history_payload = [m.dict() for m in request.history]
-    answer = query_rag(request.question, history=history_payload)
+        return [m.dict() for m in request.history]
+    return None
+
+@app.post("/ask", response_model=QueryResponse)
+async def ask(request: QueryRequest):
+    answer = await aquery_rag(request.question, history=history_payload(request))
     return QueryResponse(answer=answer)
 
+@app.post("/ask/stream")
+async def ask_stream(request: QueryRequest):
+    async def event_stream():
+        async for token in stream_rag(request.question, history=history_payload(request)):
+            if not token:
+                continue
+            # Multi-line tokens become one data: line per line, as SSE requires
+            yield "".join(f"data: {line}\n" for line in token.split("\n")) + "\n"
+        yield "event: done\ndata: \n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/generate-policy", response_model=PolicyGenerationResponse)
-def generate_policy_endpoint(request: PolicyGenerationRequest):
-    return generate_policy(request)
+async def generate_policy_endpoint(request: PolicyGenerationRequest, background_tasks: BackgroundTasks):
+    return await generate_policy(request, background_tasks)
 
 # Include metrics router
 app.include_router(metrics_router)    
\ No newline at end of file
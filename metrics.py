@@ -1,16 +1,64 @@
-from ragas import evaluate
-from ragas.metrics import faithfulness, answer_relevancy, context_precision, context_recall
-from datasets import Dataset
-from typing import List, Dict, Any
-import json
+from langchain_openai import ChatOpenAI
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import atexit
+import functools
+import numpy as np
+import orjson
 import os
+import threading
+import xxhash
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+METRICS_FILE = "metrics_log.jsonl"
+# The LLM judges add three paid calls per metrics run, each with the full context: opt-in only
+LLM_JUDGE_ENABLED = os.getenv("METRICS_LLM_JUDGE", "0").lower() in {"1", "true", "yes"}
+
+# One bounded pool for RAG and policy metrics alike: a few long-lived workers cap background
+# RAGAS work so it cannot starve request handling
+METRICS_WORKERS = int(os.getenv("METRICS_WORKERS", "2"))
+METRICS_QUEUE_LIMIT = 32
+_METRICS_POOL = ThreadPoolExecutor(max_workers=METRICS_WORKERS, thread_name_prefix="metrics")
+atexit.register(_METRICS_POOL.shutdown, wait=False)
+
+def submit_metrics(fn, *args) -> bool:
+    """Run fn(*args) on the metrics pool; returns False when it was dropped because of a backlog"""
+    # Metrics are best effort: under a burst, drop them rather than hold every pending answer and its docs
+    if _METRICS_POOL._work_queue.qsize() >= METRICS_QUEUE_LIMIT:
+        return False
+    _METRICS_POOL.submit(fn, *args)
+    return True
+
+_ragas = None
+
+def _load_ragas():
+    """Import RAGAS and datasets (which pull in torch/pandas/pyarrow) on first use only"""
+    global _ragas
+    if _ragas is None:
+        from ragas import evaluate
+        from ragas.metrics import faithfulness, answer_relevancy
+        from datasets import Dataset
+        _ragas = (evaluate, faithfulness, answer_relevancy, Dataset)
+    return _ragas
+
+def _tokenize(text: str, limit: Optional[int] = None) -> np.ndarray:
+    """Lowercased whitespace tokens of text as 32-bit xxhash ids, in order"""
+    words = text.lower().split()
+    if limit is not None:
+        words = words[:limit]
+    return np.fromiter((xxhash.xxh32_intdigest(w.encode("utf-8")) for w in words), dtype=np.uint32, count=len(words))
+
 class RAGASMetricsCollector:
     def __init__(self):
-        self.metrics_file = "metrics_log.json"
+        self.metrics_file = METRICS_FILE
+        # Judges call the sync client from worker threads: each collection runs in its own
+        # short-lived event loop, and a shared async connection pool must not outlive its loop
+        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0) if LLM_JUDGE_ENABLED else None
+        # One collector is shared by the RAG and policy metrics pools; appends must not interleave
+        self._write_lock = threading.Lock()
     
-    def calculate_faithfulness_score(self, answer: str, retrieved_context: str) -> float:
+    async def calculate_faithfulness_score(self, answer: str, retrieved_context: str) -> float:
         """Calculate how faithful the answer is to the retrieved context (1-10 scale)"""
         faithfulness_prompt = f"""
         Rate how faithful this answer is to the provided context (1-10 scale):
@@ -29,13 +77,13 @@ class RAGASMetricsCollector:
         """
         
         try:
-            response = self.llm.invoke(faithfulness_prompt)
+            response = await asyncio.to_thread(self.llm.invoke, faithfulness_prompt)
             score = float(response.content.strip())
             return max(1, min(10, score))  # Ensure score is between 1-10
         except:
             return 5.0  # Default score if evaluation fails
     
-    def detect_hallucinations(self, answer: str, retrieved_context: str) -> bool:
+    async def detect_hallucinations(self, answer: str, retrieved_context: str) -> bool:
         """Detect if answer contains information not supported by context"""
         hallucination_prompt = f"""
         Check if this answer contains information not supported by the context:
@@ -52,7 +100,7 @@ class RAGASMetricsCollector:
         """
         
         try:
-            response = self.llm.invoke(hallucination_prompt)
+            response = await asyncio.to_thread(self.llm.invoke, hallucination_prompt)
             result = int(response.content.strip())
             return bool(result)
         except:
@@ -63,24 +111,22 @@ class RAGASMetricsCollector:
         if not retrieved_context:
             return 0.0
         
+        # Index every word 3-gram of the policy once; each chunk phrase is then a set lookup
+        policy_ids = _tokenize(generated_policy).tolist()
+        policy_phrases = set(zip(policy_ids, policy_ids[1:], policy_ids[2:]))
+        
         utilized_chunks = 0
         for chunk in retrieved_context:
             # Check if significant parts of the chunk appear in the generated policy
-            chunk_words = chunk.split()[:20]  # First 20 words of chunk
-            chunk_phrases = [chunk_words[i:i+3] for i in range(0, len(chunk_words)-2, 2)]  # 3-word phrases
+            chunk_ids = _tokenize(chunk, limit=20).tolist()  # First 20 words of chunk
+            chunk_phrases = (tuple(chunk_ids[i:i+3]) for i in range(0, len(chunk_ids)-2, 2))  # 3-word phrases
             
-            # Check if any phrase from chunk appears in generated policy
-            chunk_used = any(
-                ' '.join(phrase).lower() in generated_policy.lower() 
-                for phrase in chunk_phrases
-            )
-            
-            if chunk_used:
+            if any(phrase in policy_phrases for phrase in chunk_phrases):
                 utilized_chunks += 1
         
         return utilized_chunks / len(retrieved_context)
     
-    def calculate_answer_accuracy(self, answer: str, retrieved_context: str) -> float:
+    async def calculate_answer_accuracy(self, answer: str, retrieved_context: str) -> float:
         """Calculate accuracy of the answer based on retrieved context (1-10 scale)"""
         accuracy_prompt = f"""
         Rate the accuracy of this answer based on the provided context (1-10 scale):
@@ -99,7 +145,7 @@ class RAGASMetricsCollector:
         """
         
         try:
-            response = self.llm.invoke(accuracy_prompt)
+            response = await asyncio.to_thread(self.llm.invoke, accuracy_prompt)
             score = float(response.content.strip())
             return max(1, min(10, score))  # Ensure score is between 1-10
         except:
@@ -107,66 +153,13 @@ class RAGASMetricsCollector:
     
     def evaluate_with_ragas(self, query: str, answer: str, contexts: List[str]) -> Dict[str, float]:
         """Evaluate using RAGAS metrics"""
+        # Nothing for the RAGAS judges to assess: skip the dataset and LLM calls entirely
+        if not answer.strip() or not contexts:
+            return dict.fromkeys(["faithfulness", "answer_relevancy", "context_precision", "context_recall", "ragas_score"], 0.0)
+        
         try:
-            # Create dataset for RAGAS evaluation with all required columns
-            dataset = Dataset.from_dict({
-                "question": [query],
-                "answer": [answer],
-                "contexts": [contexts],
-                "reference": [answer]  # Use answer as reference for context_precision
-            })
-            
-            # Run RAGAS evaluation with metrics that don't require additional columns
-            result = evaluate(
-                dataset,
-                metrics=[
-                    faithfulness,
-                    answer_relevancy
-                ]
-            )
-            
-            # Extract metrics from result
-            metrics_dict = {}
-            
-            # Handle RAGAS EvaluationResult object
-            if hasattr(result, 'to_pandas'):
-                # Convert to pandas DataFrame to extract metrics
-                df = result.to_pandas()
-                for col in df.columns:
-                    if col in ['faithfulness', 'answer_relevancy']:
-                        value = df[col].iloc[0] if len(df) > 0 else 0.0
-                        metrics_dict[col] = float(value)
-            elif hasattr(result, '__dict__'):
-                # Try to access attributes directly
-                for attr_name in ['faithfulness', 'answer_relevancy']:
-                    if hasattr(result, attr_name):
-                        value = getattr(result, attr_name)
-                        if isinstance(value, (int, float)):
-                            metrics_dict[attr_name] = float(value)
-                        elif hasattr(value, 'tolist'):
-                            metrics_dict[attr_name] = float(value.tolist()[0] if len(value.tolist()) > 0 else 0.0)
-            else:
-                # Fallback: try to iterate over result
-                try:
-                    for metric_name, metric_value in result:
-                        if metric_name in ['faithfulness', 'answer_relevancy']:
-                            if isinstance(metric_value, (int, float)):
-                                metrics_dict[metric_name] = float(metric_value)
-                            elif hasattr(metric_value, 'tolist'):
-                                metrics_dict[metric_name] = float(metric_value.tolist()[0] if len(metric_value.tolist()) > 0 else 0.0)
-                except:
-                    pass
-            
-            # Add simplified context metrics (without RAGAS dependency)
-            metrics_dict["context_precision"] = self._calculate_context_precision(query, contexts)
-            metrics_dict["context_recall"] = self._calculate_context_recall(query, contexts)
-            
-            # Calculate overall RAGAS score (average of all metrics)
-            if metrics_dict:
-                ragas_score = sum(metrics_dict.values()) / len(metrics_dict)
-                metrics_dict["ragas_score"] = ragas_score
-            
-            return metrics_dict
+            # Copy, since the memoized dict is shared between callers
+            return dict(self._evaluate_with_ragas_cached(query, answer, tuple(contexts)))
             
         except Exception as e:
             print(f"RAGAS evaluation failed: {e}")
@@ -179,45 +172,140 @@ class RAGASMetricsCollector:
                 "ragas_score": 0.5
             }
     
-    def _calculate_context_precision(self, query: str, contexts: List[str]) -> float:
+    @functools.lru_cache(maxsize=2048)
+    def _evaluate_with_ragas_cached(self, query: str, answer: str, contexts: Tuple[str, ...]) -> Dict[str, float]:
+        """Run RAGAS for one (query, answer, contexts); failures raise, so they are never memoized"""
+        evaluate, faithfulness, answer_relevancy, Dataset = _load_ragas()
+        
+        # Create dataset for RAGAS evaluation with all required columns
+        dataset = Dataset.from_dict({
+            "question": [query],
+            "answer": [answer],
+            "contexts": [list(contexts)],
+            "reference": [answer]  # Use answer as reference for context_precision
+        })
+        
+        # Run RAGAS evaluation with metrics that don't require additional columns.
+        # RAGAS otherwise turns a failed judge call into a NaN score, which would be memoized
+        result = evaluate(
+            dataset,
+            metrics=[
+                faithfulness,
+                answer_relevancy
+            ],
+            raise_exceptions=True
+        )
+        
+        # Extract metrics from result
+        metrics_dict = {}
+        
+        # Handle RAGAS EvaluationResult object
+        if getattr(result, 'scores', None):
+            # Per-row score dicts, no pandas round-trip needed
+            row = result.scores[0]
+            for metric_name in ['faithfulness', 'answer_relevancy']:
+                if metric_name in row:
+                    metrics_dict[metric_name] = float(row[metric_name])
+        elif hasattr(result, 'to_pandas'):
+            # Convert to pandas DataFrame to extract metrics
+            df = result.to_pandas()
+            for col in df.columns:
+                if col in ['faithfulness', 'answer_relevancy']:
+                    value = df[col].iloc[0] if len(df) > 0 else 0.0
+                    metrics_dict[col] = float(value)
+        elif hasattr(result, '__dict__'):
+            # Try to access attributes directly
+            for attr_name in ['faithfulness', 'answer_relevancy']:
+                if hasattr(result, attr_name):
+                    value = getattr(result, attr_name)
+                    if isinstance(value, (int, float)):
+                        metrics_dict[attr_name] = float(value)
+                    elif hasattr(value, 'tolist'):
+                        metrics_dict[attr_name] = float(value.tolist()[0] if len(value.tolist()) > 0 else 0.0)
+        else:
+            # Fallback: try to iterate over result
+            try:
+                for metric_name, metric_value in result:
+                    if metric_name in ['faithfulness', 'answer_relevancy']:
+                        if isinstance(metric_value, (int, float)):
+                            metrics_dict[metric_name] = float(metric_value)
+                        elif hasattr(metric_value, 'tolist'):
+                            metrics_dict[metric_name] = float(metric_value.tolist()[0] if len(metric_value.tolist()) > 0 else 0.0)
+            except:
+                pass
+        
+        if any(np.isnan(value) for value in metrics_dict.values()):
+            raise ValueError(f"RAGAS returned NaN scores: {metrics_dict}")
+        
+        # Add simplified context metrics (without RAGAS dependency)
+        # Tokenize once; both helpers work on the same hashed id arrays
+        query_ids = _tokenize(query)
+        context_ids = [_tokenize(context) for context in contexts]
+        metrics_dict["context_precision"] = self._calculate_context_precision(query_ids, context_ids)
+        metrics_dict["context_recall"] = self._calculate_context_recall(query_ids, context_ids)
+        
+        # Calculate overall RAGAS score (average of all metrics)
+        if metrics_dict:
+            ragas_score = sum(metrics_dict.values()) / len(metrics_dict)
+            metrics_dict["ragas_score"] = ragas_score
+        
+        return metrics_dict
+    
+    async def _evaluate_all(self, query: str, answer: str, contexts: List[str]) -> Tuple[Dict[str, float], Dict[str, Any]]:
+        """Run RAGAS and the LLM judges concurrently; latency is the slowest call, not the sum"""
+        retrieved_context = "\n\n".join(contexts)
+        ragas_metrics, faithfulness_score, hallucination, accuracy = await asyncio.gather(
+            asyncio.to_thread(self.evaluate_with_ragas, query, answer, contexts),
+            self.calculate_faithfulness_score(answer, retrieved_context),
+            self.detect_hallucinations(answer, retrieved_context),
+            self.calculate_answer_accuracy(answer, retrieved_context),
+        )
+        llm_judge = {
+            "faithfulness_score": faithfulness_score,
+            "hallucination_detected": hallucination,
+            "answer_accuracy": accuracy,
+        }
+        return ragas_metrics, llm_judge
+
+    def _evaluate(self, query: str, answer: str, contexts: List[str]) -> Tuple[Dict[str, float], Optional[Dict[str, Any]]]:
+        """RAGAS scores, plus the LLM judge verdicts when METRICS_LLM_JUDGE is enabled"""
+        if self.llm is None:
+            return self.evaluate_with_ragas(query, answer, contexts), None
+        return asyncio.run(self._evaluate_all(query, answer, contexts))
+    
+    def _calculate_context_precision(self, query_ids: np.ndarray, context_ids: List[np.ndarray]) -> float:
         """Calculate context precision as percentage of relevant contexts"""
-        if not contexts:
+        if not context_ids:
             return 0.0
         
-        query_words = set(query.lower().split())
-        relevant_contexts = 0
-        
-        for context in contexts:
-            context_words = set(context.lower().split())
-            # Calculate overlap between query and context
-            overlap = len(query_words.intersection(context_words))
-            relevance_threshold = len(query_words) * 0.3  # 30% overlap threshold
-            if overlap >= relevance_threshold:
-                relevant_contexts += 1
+        query_terms = np.unique(query_ids)
+        relevance_threshold = query_terms.size * 0.3  # 30% overlap threshold
+        relevant_contexts = sum(
+            int(np.intersect1d(query_terms, ids).size >= relevance_threshold)
+            for ids in context_ids
+        )
         
-        return relevant_contexts / len(contexts)
+        return relevant_contexts / len(context_ids)
     
-    def _calculate_context_recall(self, query: str, contexts: List[str]) -> float:
+    def _calculate_context_recall(self, query_ids: np.ndarray, context_ids: List[np.ndarray]) -> float:
         """Calculate context recall as coverage of query terms"""
-        if not contexts:
+        if not context_ids:
             return 0.0
         
-        query_words = set(query.lower().split())
-        all_context_words = set()
-        
-        for context in contexts:
-            all_context_words.update(context.lower().split())
+        query_terms = np.unique(query_ids)
+        if not query_terms.size:
+            return 0.0
         
         # Calculate how many query terms are covered by contexts
-        covered_terms = len(query_words.intersection(all_context_words))
-        return covered_terms / len(query_words) if query_words else 0.0
+        covered_terms = np.isin(query_terms, np.concatenate(context_ids)).sum()
+        return float(covered_terms) / query_terms.size
     
     def collect_rag_metrics(self, query: str, answer: str, retrieved_docs: List[Any]) -> Dict[str, Any]:
         """Collect all RAG-related metrics using RAGAS"""
         contexts = [doc.page_content for doc in retrieved_docs]
         
-        # Get RAGAS metrics
-        ragas_metrics = self.evaluate_with_ragas(query, answer, contexts)
+        # Get RAGAS (and, if enabled, LLM judge) metrics
+        ragas_metrics, llm_judge = self._evaluate(query, answer, contexts)
         
         metrics = {
             "timestamp": datetime.now().isoformat(),
@@ -227,6 +315,8 @@ class RAGASMetricsCollector:
             "context_length": sum(len(context) for context in contexts),
             "interpretation": self._interpret_ragas_scores(ragas_metrics)
         }
+        if llm_judge is not None:
+            metrics["llm_judge"] = llm_judge
         
         return metrics
     
@@ -237,8 +327,8 @@ class RAGASMetricsCollector:
         # Create a query for policy generation evaluation
         query = f"Generate AI policy for {target_country} educational institution"
         
-        # Get RAGAS metrics
-        ragas_metrics = self.evaluate_with_ragas(query, generated_policy, contexts)
+        # Get RAGAS (and, if enabled, LLM judge) metrics
+        ragas_metrics, llm_judge = self._evaluate(query, generated_policy, contexts)
         
         metrics = {
             "timestamp": datetime.now().isoformat(),
@@ -248,25 +338,20 @@ class RAGASMetricsCollector:
             "policy_length": len(generated_policy),
             "interpretation": self._interpret_ragas_scores(ragas_metrics)
         }
+        if llm_judge is not None:
+            metrics["llm_judge"] = llm_judge
         
         return metrics
     
     def save_metrics(self, metrics: Dict[str, Any], metric_type: str = "rag"):
-        """Save metrics to file"""
-        if not os.path.exists(self.metrics_file):
-            with open(self.metrics_file, 'w') as f:
-                json.dump({}, f)
-        
-        with open(self.metrics_file, 'r') as f:
-            all_metrics = json.load(f)
-        
-        if metric_type not in all_metrics:
-            all_metrics[metric_type] = []
-        
-        all_metrics[metric_type].append(metrics)
-        
-        with open(self.metrics_file, 'w') as f:
-            json.dump(all_metrics, f, indent=2)
+        """Append metrics to the JSONL log (one record per line, never rewritten)"""
+        line = orjson.dumps({"type": metric_type, **metrics}, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+        with self._write_lock, open(self.metrics_file, 'ab') as f:
+            f.write(line)
+
+    def clear_metrics(self):
+        with self._write_lock:
+            open(self.metrics_file, 'w').close()
     
     def _interpret_ragas_scores(self, ragas_metrics: Dict[str, float]) -> Dict[str, str]:
         """Interpret RAGAS scores for better understanding"""
@@ -337,38 +422,71 @@ class RAGASMetricsCollector:
         if not os.path.exists(self.metrics_file):
             return {"error": "No metrics file found"}
         
-        with open(self.metrics_file, 'r') as f:
-            all_metrics = json.load(f)
+        # Single streaming pass over the log; each record adds one row to its type's running sums
+        fields = ["ragas_score", "faithfulness", "answer_relevancy", "context_precision", "context_recall"]
+        judge_fields = ["faithfulness_score", "hallucination_detected", "answer_accuracy"]
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        # Judge verdicts exist only for records collected with METRICS_LLM_JUDGE on
+        judge_sums: Dict[str, np.ndarray] = {}
+        judge_counts: Dict[str, int] = {}
+        
+        with open(self.metrics_file, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                m = orjson.loads(line)
+                metric_type = m.get("type", "rag")
+                scores = m.get("ragas_metrics", {})
+                row = np.array(
+                    [scores.get(field, 0) for field in fields]
+                    + [m.get("num_retrieved_docs", m.get("num_retrieved_sources", 0))],
+                    dtype=np.float64
+                )
+                if metric_type in sums:
+                    sums[metric_type] += row
+                    counts[metric_type] += 1
+                else:
+                    sums[metric_type] = row
+                    counts[metric_type] = 1
+                
+                judge = m.get("llm_judge")
+                if judge:
+                    judge_row = np.array([judge.get(field, 0) for field in judge_fields], dtype=np.float64)
+                    if metric_type in judge_sums:
+                        judge_sums[metric_type] += judge_row
+                        judge_counts[metric_type] += 1
+                    else:
+                        judge_sums[metric_type] = judge_row
+                        judge_counts[metric_type] = 1
         
         summary = {}
-        
-        for metric_type, metrics_list in all_metrics.items():
-            if not metrics_list:
-                continue
-            
-            # Calculate averages for RAGAS metrics
-            ragas_scores = [m.get("ragas_metrics", {}) for m in metrics_list]
-            
-            # Avoid division by zero
-            if ragas_scores:
-                summary[metric_type] = {
-                    "total_queries": len(metrics_list),
-                    "avg_ragas_score": sum(s.get("ragas_score", 0) for s in ragas_scores) / len(ragas_scores),
-                    "avg_faithfulness": sum(s.get("faithfulness", 0) for s in ragas_scores) / len(ragas_scores),
-                    "avg_answer_relevancy": sum(s.get("answer_relevancy", 0) for s in ragas_scores) / len(ragas_scores),
-                    "avg_context_precision": sum(s.get("context_precision", 0) for s in ragas_scores) / len(ragas_scores),
-                    "avg_context_recall": sum(s.get("context_recall", 0) for s in ragas_scores) / len(ragas_scores),
-                    "avg_retrieved_docs": sum(m.get("num_retrieved_docs", m.get("num_retrieved_sources", 0)) for m in metrics_list) / len(metrics_list)
-                }
-            else:
-                summary[metric_type] = {
-                    "total_queries": len(metrics_list),
-                    "avg_ragas_score": 0,
-                    "avg_faithfulness": 0,
-                    "avg_answer_relevancy": 0,
-                    "avg_context_precision": 0,
-                    "avg_context_recall": 0,
-                    "avg_retrieved_docs": 0
-                }
+        for metric_type, total in sums.items():
+            averages = (total / counts[metric_type]).tolist()
+            summary[metric_type] = {
+                "total_queries": counts[metric_type],
+                **{f"avg_{field}": value for field, value in zip(fields, averages)},
+                "avg_retrieved_docs": averages[-1]
+            }
+            if metric_type in judge_sums:
+                faithfulness, hallucination, accuracy = (judge_sums[metric_type] / judge_counts[metric_type]).tolist()
+                summary[metric_type].update({
+                    "judged_queries": judge_counts[metric_type],
+                    "avg_judge_faithfulness": faithfulness,
+                    "hallucination_rate": hallucination,
+                    "avg_judge_accuracy": accuracy,
+                })
         
         return summary
+
+_collector = None
+_collector_lock = threading.Lock()
+
+def get_collector() -> RAGASMetricsCollector:
+    """Process-wide collector, so its LLM client and lazily loaded evaluators are built once"""
+    global _collector
+    if _collector is None:
+        with _collector_lock:
+            if _collector is None:
+                _collector = RAGASMetricsCollector()
+    return _collector
@@ -1,27 +1,31 @@
 from fastapi import APIRouter
-from metrics import RAGASMetricsCollector
-import json
+from fastapi.responses import StreamingResponse
+from metrics import get_collector, METRICS_FILE
+import os
 
 router = APIRouter()
 
 @router.get("/metrics/summary")
 def get_metrics_summary():
-    collector = RAGASMetricsCollector()
+    collector = get_collector()
     return collector.get_metrics_summary()
 
 @router.get("/metrics/raw")
 def get_raw_metrics():
-    try:
-        with open("metrics_log.json", 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
+    if not os.path.exists(METRICS_FILE):
         return {"error": "No metrics data found"}
 
+    def iter_records():
+        with open(METRICS_FILE, 'rb') as f:
+            yield from f
+
+    # Newline-delimited JSON, one metrics record per line
+    return StreamingResponse(iter_records(), media_type="application/x-ndjson")
+
 @router.delete("/metrics/clear")
 def clear_metrics():
     try:
-        with open("metrics_log.json", 'w') as f:
-            json.dump({}, f)
+        get_collector().clear_metrics()
         return {"message": "Metrics cleared successfully"}
     except Exception as e:
-        return {"error": f"Failed to clear metrics: {str(e)}"}
+        return {"error": f"Failed to clear metrics: {str(e)}"}
\ No newline at end of file
@@ -1,49 +1,80 @@
 from rag_index import build_or_load_index
 from langchain_openai import ChatOpenAI
-from langchain.chains import LLMChain
+from langchain_core.output_parsers import StrOutputParser
 from models import PolicyGenerationRequest, PolicyGenerationResponse
 from policy_prompt import policy_prompt
-from metrics import RAGASMetricsCollector
-import threading
+from metrics import get_collector, submit_metrics
+from fastapi import BackgroundTasks
+from functools import lru_cache
+from typing import List, Optional, Tuple
+import asyncio
+import io
 
 db = build_or_load_index()
-retriever = db.as_retriever(search_kwargs={"k": 20})
 llm = ChatOpenAI(model="gpt-4o-mini")
+policy_chain = policy_prompt | llm | StrOutputParser()
 
-def generate_policy(request: PolicyGenerationRequest) -> PolicyGenerationResponse:
-    query = f"AI policy for {request.level} schools in {request.country}"
-    retrieved_docs = retriever.get_relevant_documents(query)
-    context = "\n\n".join([d.page_content[:1200] for d in retrieved_docs])
-
-    chain = LLMChain(llm=llm, prompt=policy_prompt)
-    result = chain.run(
-        school=request.school,
-        country=request.country,
-        level=request.level,
-        requirements=request.requirements or "None specified",
-        scope=", ".join(request.scope or []),
-        context=context,
-    )
+CHUNK_CHAR_LIMIT = 1200
+CONTEXT_CHAR_BUDGET = 12000
 
-    # Async metrics collection
-    def _collect_policy_metrics_async(generated_result, retrieved_docs_list, country):
-        try:
-            metrics_collector = RAGASMetricsCollector()
-            policy_metrics = metrics_collector.collect_policy_metrics(
-                generated_result,
-                [{"content": d.page_content, **d.metadata} for d in retrieved_docs_list],
-                country
-            )
-            metrics_collector.save_metrics(policy_metrics, "policy")
-        except Exception as e:
-            print(f"Error collecting policy metrics asynchronously: {e}")
-
-    thread = threading.Thread(
-        target=_collect_policy_metrics_async,
-        args=(result, retrieved_docs, request.country),
-    )
-    thread.daemon = True
-    thread.start()
+def build_context(docs: List, budget: int = CONTEXT_CHAR_BUDGET) -> Tuple[str, List]:
+    """Concatenate chunks into the prompt context until the character budget runs out"""
+    buffer = io.StringIO()
+    used_docs = []
+    total = 0
+    for d in docs:
+        chunk = d.page_content[:min(CHUNK_CHAR_LIMIT, budget - total)]
+        if not chunk:
+            break
+        if used_docs:
+            buffer.write("\n\n")
+        buffer.write(chunk)
+        total += len(chunk)
+        used_docs.append(d)
+    return buffer.getvalue(), used_docs
+
+@lru_cache(maxsize=1024)
+def retrieve_policy_docs(level: str, country: str) -> Tuple:
+    """Docs for a (level, country) pair; the query is low-cardinality, so repeats skip embedding and search"""
+    query = f"AI policy for {level} schools in {country}"
+    # MMR drops near-duplicate chunks so the budget goes to distinct sources
+    return tuple(db.max_marginal_relevance_search(query, k=20, fetch_k=60, lambda_mult=0.5))
+
+def _collect_policy_metrics(generated_result, retrieved_docs_list, country):
+    try:
+        metrics_collector = get_collector()
+        policy_metrics = metrics_collector.collect_policy_metrics(
+            generated_result,
+            [{"content": d.page_content, **d.metadata} for d in retrieved_docs_list],
+            country
+        )
+        metrics_collector.save_metrics(policy_metrics, "policy")
+    except Exception as e:
+        print(f"Error collecting policy metrics asynchronously: {e}")
+
+def collect_policy_metrics_async(generated_result, retrieved_docs_list, country):
+    """Queue policy metrics on the shared metrics pool; dropped, like RAG metrics, under a backlog"""
+    if not submit_metrics(_collect_policy_metrics, generated_result, retrieved_docs_list, country):
+        print(f"Metrics queue full, skipping policy metrics for {country}")
+
+async def generate_policy(request: PolicyGenerationRequest, background_tasks: Optional[BackgroundTasks] = None) -> PolicyGenerationResponse:
+    candidates = await asyncio.to_thread(retrieve_policy_docs, request.level, request.country)
+    context, retrieved_docs = build_context(candidates)
+
+    result = await policy_chain.ainvoke({
+        "school": request.school,
+        "country": request.country,
+        "level": request.level,
+        "requirements": request.requirements or "None specified",
+        "scope": ", ".join(request.scope or []),
+        "context": context,
+    })
+
+    # Metrics run after the response is sent, on the bounded pool
+    if background_tasks is not None:
+        background_tasks.add_task(collect_policy_metrics_async, result, retrieved_docs, request.country)
+    else:
+        collect_policy_metrics_async(result, retrieved_docs, request.country)
 
     return PolicyGenerationResponse(
         generated_policy=result,
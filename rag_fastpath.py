@@ -0,0 +1,42 @@
+"""Per-request string helpers on the query hot path.
+
+Plain, fully annotated Python so the module can be compiled with `mypyc rag_fastpath.py`.
+The import system prefers the compiled extension when it is present next to this file
+and falls back to this source otherwise, so callers import it the same way either way.
+"""
+import hashlib
+from typing import Dict, List, Optional
+
+HISTORY_TURNS = 6
+
+def history_hint(history: Optional[List[Dict[str, str]]]) -> str:
+    """The recent turns that condition a follow-up, or "" for a standalone question"""
+    if not history:
+        return ""
+    return " | ".join(
+        f"{msg['role']}: {msg['content']}"
+        for msg in history[-HISTORY_TURNS:]
+        if msg.get("role") in ("user", "assistant") and msg.get("content")
+    )
+
+def rewrite_question_with_history(question: str, history: Optional[List[Dict[str, str]]]) -> str:
+    # Simple heuristic rewriter: append prior QA context to bias retrieval
+    hint = history_hint(history)
+    if not hint:
+        return question
+    return f"[Follow-up based on: {hint}] {question}"
+
+def expand_queries(question: str, history: Optional[List[Dict[str, str]]]) -> List[str]:
+    """Retrieval variants: history-conditioned query first (it keys the caches), the bare question,
+    and the last assistant turn, which carries the subject of most follow-ups"""
+    queries = [rewrite_question_with_history(question, history), question]
+    if history:
+        for msg in reversed(history):
+            if msg.get("role") == "assistant" and msg.get("content"):
+                queries.append(msg["content"])
+                break
+    return list(dict.fromkeys(queries))
+
+def request_key(expanded_query: str) -> str:
+    """Key for in-flight dedup of identical queries"""
+    return hashlib.sha256(expanded_query.encode("utf-8")).hexdigest()
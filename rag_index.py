@@ -1,33 +1,173 @@
 import os
 import re
-import fitz
 import json
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import httpx
+import faiss
+import xxhash
+import numpy as np
+from functools import lru_cache
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from selectolax.lexbor import LexborHTMLParser
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-INDEX_DIR = "data/ai_policies_index"
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "openai").lower()
+# Each embedding model needs its own index: vectors from different models are not comparable
+INDEX_DIR = "data/ai_policies_index" if EMBEDDINGS_BACKEND == "openai" else f"data/ai_policies_index_{EMBEDDINGS_BACKEND}"
+
+# ANN structure used when (re)building: "hnsw" (graph over int8 codes), "ivfpq" or "flat" (exact fp32)
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "hnsw").lower()
+
+# Search-time speed/recall trade-off, applied on load so switching needs no rebuild.
+# FAISS widens the HNSW beam to max(efSearch, k) on its own, so a profile below a caller's k
+# (RAG_FETCH_K=40, policy_agent's fetch_k=60) still returns k results, with less headroom for recall
+SEARCH_PROFILES = {
+    "fast": {"ef_search": 48, "nprobe": 4},
+    "balanced": {"ef_search": 64, "nprobe": 16},
+    "recall-max": {"ef_search": 256, "nprobe": 64},
+}
+_profile_name = os.getenv("FAISS_SEARCH_PROFILE", "balanced").lower()
+if _profile_name not in SEARCH_PROFILES:
+    raise ValueError(f"Unknown FAISS_SEARCH_PROFILE {_profile_name!r}; expected one of: {', '.join(SEARCH_PROFILES)}")
+SEARCH_PROFILE = SEARCH_PROFILES[_profile_name]
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", SEARCH_PROFILE["ef_search"]))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", SEARCH_PROFILE["nprobe"]))
+
+# Chunks per embedding request and requests in flight while building (keep under the TPM quota)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "512"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+_CLEAN_RE = re.compile(r"(?:\s*Page\s+\d+)+\s*|\s+")
 
 def clean_text(text: str) -> str:
-    text = re.sub(r"\s+", " ", text)
-    text = re.sub(r"Page \d+", "", text)
-    return text.strip()
+    # One pass: page markers and whitespace runs both collapse to a single space
+    return _CLEAN_RE.sub(" ", text).strip()
 
 def extract_pdf(path: str) -> str:
-    doc = fitz.open(path)
-    text = " ".join([page.get_text("text") for page in doc])
+    import fitz  # only needed when (re)building the index
+
+    with fitz.open(path) as doc:
+        text = " ".join(page.get_text("text") for page in doc)
     return clean_text(text)
 
-def extract_webpage(url: str) -> str:
-    html = requests.get(url).text
-    soup = BeautifulSoup(html, "html.parser")
-    return clean_text(soup.get_text())
+def extract_pdf_worker(task: tuple) -> tuple:
+    path, meta = task
+    return extract_pdf(path), meta
+
+async def extract_webpage(url: str, client: httpx.AsyncClient) -> str:
+    response = await client.get(url)
+    tree = LexborHTMLParser(response.text)
+    tree.strip_tags(["script", "style"])
+    root = tree.body or tree.root
+    return clean_text(root.text(separator=" ") if root else "")
+
+async def extract_webpages(urls: list) -> list:
+    # Fetch all pages concurrently over one shared connection pool
+    async with httpx.AsyncClient(timeout=30, follow_redirects=True) as client:
+        return await asyncio.gather(*(extract_webpage(url, client) for url in urls))
+
+def run_sync(coro):
+    """Run a coroutine to completion from sync code, even inside a running loop
+    (uvicorn imports the app, and so builds the index, from within its loop)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+@lru_cache(maxsize=1)
+def get_embeddings():
+    # One client (or ONNX session) per process, shared by every index loaded in it
+    if EMBEDDINGS_BACKEND == "onnx":
+        # Local quantized model: no network round-trip to embed each query
+        from local_embeddings import ONNXEmbeddings, DEFAULT_MODEL
+        return ONNXEmbeddings(os.getenv("ONNX_EMBEDDING_MODEL", DEFAULT_MODEL))
+    return OpenAIEmbeddings(chunk_size=EMBED_BATCH_SIZE)
+
+async def embed_texts(embeddings, texts: list) -> np.ndarray:
+    """Embed texts in fixed-size batches with several requests in flight"""
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return np.asarray([vector for batch in results for vector in batch], dtype=np.float32)
+
+def build_faiss_index(vectors: np.ndarray):
+    n, d = vectors.shape
+
+    if FAISS_INDEX_TYPE == "hnsw":
+        # HNSW graph walk over 8-bit scalar-quantized vectors: 4x smaller than fp32
+        index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_8bit, 32)
+        index.hnsw.efConstruction = 80
+        index.train(vectors)
+        index.add(vectors)
+    elif FAISS_INDEX_TYPE == "ivfpq":
+        # Roughly 39 training points per centroid keeps k-means stable on small corpora
+        nlist = max(1, min(256, n // 39))
+        m = next(m for m in (48, 32, 16, 8, 4, 2, 1) if d % m == 0)
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, m, 8)
+        index.train(vectors)
+        index.add(vectors)
+        # MMR search reconstructs vectors by id
+        index.make_direct_map()
+    else:
+        index = faiss.IndexFlatL2(d)
+        index.add(vectors)
+
+    return index
+
+def configure_index(index):
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = min(IVF_NPROBE, index.nlist)
+
+CHUNK_IDS_FILE = "chunk_ids.txt"
+
+def chunk_id(text: str) -> str:
+    # Content hash: a chunk keeps its id across restarts and index rebuilds
+    return xxhash.xxh64_hexdigest(text.encode("utf-8"))
+
+def save_chunk_ids(docs: List[Document], index_dir: str = INDEX_DIR):
+    """Stable chunk ids in FAISS row order, one per line; the texts themselves stay in the docstore"""
+    with open(os.path.join(index_dir, CHUNK_IDS_FILE), "w") as f:
+        f.writelines(chunk_id(d.page_content) + "\n" for d in docs)
+
+def _chunk_ids_match(db, ids: List[str]) -> bool:
+    # A stale file (index saved elsewhere, or a build that died before save_chunk_ids) would key
+    # contexts to the wrong chunks: check the row count and spot-check the first and last rows
+    n = db.index.ntotal
+    if len(ids) != n:
+        return False
+    return all(
+        ids[i] == chunk_id(db.docstore.search(db.index_to_docstore_id[i]).page_content)
+        for i in {0, n - 1} if n
+    )
+
+def load_chunk_ids(db, index_dir: str = INDEX_DIR) -> List[str]:
+    path = os.path.join(index_dir, CHUNK_IDS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            ids = f.read().split()
+        if _chunk_ids_match(db, ids):
+            return ids
+        print(f"Ignoring {path}: it does not match the loaded index")
+    # Indexes saved without (or with a stale) id file: hash the docstore texts
+    return [chunk_id(db.docstore.search(db.index_to_docstore_id[i]).page_content) for i in range(db.index.ntotal)]
 
 def build_or_load_index(base_folder: str = "data/policies", force_rebuild: bool = False):
-    embeddings = OpenAIEmbeddings()
+    embeddings = get_embeddings()
 
     # Allow forcing a rebuild via function arg or env var
     env_force = os.getenv("FORCE_REBUILD", "0").lower() in {"1", "true", "yes"}
@@ -35,10 +175,12 @@ def build_or_load_index(base_folder: str = "data/policies", force_rebuild: bool
 
     if os.path.exists(INDEX_DIR) and not force:
         print("Loading existing FAISS index")
-        return FAISS.load_local(INDEX_DIR, embeddings, allow_dangerous_deserialization=True)
+        db = FAISS.load_local(INDEX_DIR, embeddings, allow_dangerous_deserialization=True)
+        configure_index(db.index)
+        return db
 
     print("Building new FAISS index")
-    policies = []
+    pdf_tasks = []
 
     for level in os.listdir(base_folder):
         level_path = os.path.join(base_folder, level)
@@ -56,50 +198,58 @@ def build_or_load_index(base_folder: str = "data/policies", force_rebuild: bool
 
                 path = os.path.join(country_path, file)
                 school = os.path.splitext(file)[0]
-                content = extract_pdf(path)
-
-                policies.append({
-                    "content": content,
-                    "metadata": {
-                        "school": school,
-                        "country": country,
-                        "level": level,
-                        "source": path
-                    }
-                })
-
-    with open("data/web.json", "r") as f:
-        webpages = json.load(f)
-
-    for w in webpages:
-        content = extract_webpage(w["url"])
-        policies.append({
-            "content": content,
-            "metadata": {
-                "school": w["school"],
-                "country": w["country"],
-                "level": w["level"],
-                "source": w["url"]
-            }
-        })
+                pdf_tasks.append((path, {
+                    "school": school,
+                    "country": country,
+                    "level": level,
+                    "source": path
+                }))
 
     splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
     docs = []
-    for p in policies:
-        meta = p["metadata"]
+
+    def add_policy(content: str, meta: dict):
         header = (
             f"Level: {meta['level']}\n"
             f"Country: {meta['country']}\n"
             f"School: {meta['school']}\n"
         )
-        for i, chunk in enumerate(splitter.split_text(p["content"])):
+        for i, chunk in enumerate(splitter.split_text(content)):
             docs.append(Document(
                 page_content=header + "\n" + chunk,
                 metadata={**meta, "chunk": i}
             ))
 
+    # PDF extraction is CPU-bound and independent per file: run it across processes
+    # and split each policy as soon as its text arrives
+    with ProcessPoolExecutor() as pool:
+        for content, meta in pool.map(extract_pdf_worker, pdf_tasks):
+            add_policy(content, meta)
+
+    with open("data/web.json", "r") as f:
+        webpages = json.load(f)
+
+    contents = run_sync(extract_webpages([w["url"] for w in webpages]))
+    for w, content in zip(webpages, contents):
+        add_policy(content, {
+            "school": w["school"],
+            "country": w["country"],
+            "level": w["level"],
+            "source": w["url"]
+        })
+
     print(f"Created {len(docs)} chunks")
 
-    db = FAISS.from_documents(docs, embeddings)
+    vectors = run_sync(embed_texts(embeddings, [d.page_content for d in docs]))
+    index = build_faiss_index(vectors)
+    configure_index(index)
+
+    db = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore({str(i): d for i, d in enumerate(docs)}),
+        index_to_docstore_id={i: str(i) for i in range(len(docs))},
+    )
     db.save_local(INDEX_DIR)
+    save_chunk_ids(docs)
     return db
\ No newline at end of file
@@ -1,16 +1,109 @@
-from rag_index import build_or_load_index
+from rag_index import EMBEDDINGS_BACKEND, build_or_load_index, load_chunk_ids
 from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from typing import List, Optional
-from metrics import RAGASMetricsCollector
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain.schema import Document
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from functools import lru_cache
+from metrics import get_collector, submit_metrics
+from semantic_cache import make_cache
+from rag_fastpath import expand_queries, history_hint, request_key
+import numpy as np
+import faiss
+import httpx
+import asyncio
+import atexit
+import logging
+import queue
+import random
 import threading
 import time
+import os
+from logging.handlers import QueueHandler, QueueListener
+
+# Background threads log through a queue so they never contend for the stdout lock
+logger = logging.getLogger("rag")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_handler = QueueHandler(queue.Queue(-1))
+logger.addHandler(_log_handler)
+_log_listener: Optional[QueueListener] = None
+
+def _start_log_listener():
+    global _log_listener
+    # A fresh queue per process: with gunicorn --preload the master's listener thread does not survive fork
+    _log_handler.queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _log_listener = QueueListener(_log_handler.queue, stream_handler)
+    _log_listener.start()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
 
 db = build_or_load_index()
-retriever = db.as_retriever(search_kwargs={"k": 20})
+# Content-hash id of each FAISS row; stays the same across restarts and rebuilds
+CHUNK_IDS = load_chunk_ids(db)
+CHUNK_ROWS = {cid: row for row, cid in enumerate(CHUNK_IDS)}
+
+# Explicit pools so concurrent requests reuse warm keepalive connections to the API
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+# Deterministic, capped completions: repeat questions get the same answer the semantic cache
+# would serve, and the stop sequences end a reply that starts echoing the prompt
+llm = ChatOpenAI(
+    model="gpt-4o-mini",
+    temperature=0,
+    max_tokens=400,
+    streaming=True,
+    timeout=30,
+    max_retries=2,
+    stop=["\n\nQuestion:", "\n\nContext:"],
+    http_client=httpx.Client(limits=HTTP_LIMITS),
+    http_async_client=httpx.AsyncClient(limits=HTTP_LIMITS),
+)
+# In-process LRU by default; RAG_CACHE_BACKEND=redis://... shares it across workers and restarts
+semantic_cache = make_cache()
+
+# RAG_LEGACY_CHAIN=1 falls back to RetrievalQA, which re-embeds the query inside its retriever
+USE_LEGACY_CHAIN = os.getenv("RAG_LEGACY_CHAIN", "0").lower() in {"1", "true", "yes"}
 
-llm = ChatOpenAI(model="gpt-4o-mini")
+# Metrics are read as aggregates, so a sample is enough; weak answers are always measured
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0.1"))
+METRICS_DOC_CHAR_LIMIT = 1500
+_WEAK_ANSWER_MARKERS = ("i don't know", "i do not know", "no information", "not mentioned", "does not mention", "not explicit")
+
+# In-flight queries by sha256 of the expanded query; only touched from the owning event loop
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+# _INFLIGHT, _EMBED_CACHE and the LLM's async connection pool all belong to one event loop at a time:
+# the server's, or query_rag's private loop in scripts. A process uses one or the other
+_owner_loop: Optional[asyncio.AbstractEventLoop] = None
+_owner_lock = threading.Lock()
+_sync_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_lock = threading.Lock()
+
+def _claim_loop():
+    global _owner_loop
+    loop = asyncio.get_running_loop()
+    with _owner_lock:
+        if _owner_loop is loop:
+            return
+        if _owner_loop is not None and not _owner_loop.is_closed():
+            raise RuntimeError(
+                "rag_query is already in use by another event loop in this process; "
+                "use either the async API (aquery_rag, stream_rag) or the sync query_rag, not both"
+            )
+        _owner_loop = loop
+
+# Reciprocal-rank fusion constant (the usual 60 from the original RRF paper)
+RRF_K = 60
+
+# Retrieve a wide candidate set cheaply, then keep only a few diverse chunks for the prompt
+FETCH_K = int(os.getenv("RAG_FETCH_K", "40"))
+TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.5"))
 
 prompt = PromptTemplate(
     template=(
@@ -28,52 +121,242 @@ prompt = PromptTemplate(
     input_variables=["context", "question"],
 )
 
-qa_chain = RetrievalQA.from_chain_type(
-    llm=llm,
-    retriever=retriever,
-    return_source_documents=True,
-    chain_type="stuff",
-    chain_type_kwargs={"prompt": prompt}
-)
+qa_chain = None
+if USE_LEGACY_CHAIN:
+    # Only the legacy path pays for importing and wiring LangChain's chain machinery
+    from langchain.chains import RetrievalQA
+
+    qa_chain = RetrievalQA.from_chain_type(
+        llm=llm,
+        retriever=db.as_retriever(search_kwargs={"k": 20}),
+        return_source_documents=True,
+        chain_type="stuff",
+        chain_type_kwargs={"prompt": prompt}
+    )
+
+# Query variants -> embeddings, least recently used first; only touched from the owning event loop
+_EMBED_CACHE: "OrderedDict[Tuple[str, ...], np.ndarray]" = OrderedDict()
+EMBED_CACHE_SIZE = 512
+
+async def embed_queries(queries: Tuple[str, ...]) -> np.ndarray:
+    """All variants go out in one batched call; exact repeats skip the embedding call entirely"""
+    cached = _EMBED_CACHE.get(queries)
+    if cached is not None:
+        _EMBED_CACHE.move_to_end(queries)
+        return cached
+
+    if EMBEDDINGS_BACKEND == "openai":
+        # Native async client: waiting on the API holds no thread
+        vectors = await db.embedding_function.aembed_documents(list(queries))
+    else:
+        # Local models are CPU-bound, so they run in a worker thread
+        vectors = await asyncio.to_thread(db.embedding_function.embed_documents, list(queries))
+
+    query_embeddings = np.asarray(vectors, dtype=np.float32)
+    _EMBED_CACHE[queries] = query_embeddings
+    if len(_EMBED_CACHE) > EMBED_CACHE_SIZE:
+        _EMBED_CACHE.popitem(last=False)
+    return query_embeddings
+
+def lookup_or_retrieve(query_embeddings: np.ndarray, question_row: int, scope: str) -> Tuple[Optional[str], List, str]:
+    """Worker-thread half of a query: answer cache lookup, then on a miss FAISS search, MMR and
+    context rendering. Returns (cached answer, retrieved docs, context)"""
+    try:
+        cached_answer = semantic_cache.search(query_embeddings[question_row], scope=scope)
+    except Exception:
+        # The cache is an optimization: an unreachable backend must not fail the query
+        logger.exception("Semantic cache lookup failed")
+        cached_answer = None
+    if cached_answer is not None or USE_LEGACY_CHAIN:
+        return cached_answer, [], ""
+
+    doc_ids = tuple(retrieve(query_embeddings))
+    return None, lookup_docs(doc_ids), render_context(tuple(CHUNK_IDS[i] for i in doc_ids))
+
+def store_answer(query_embedding: np.ndarray, question: str, answer: str, scope: str):
+    try:
+        semantic_cache.insert(query_embedding, question, answer, scope=scope)
+    except Exception:
+        logger.exception("Semantic cache insert failed")
+
+def fused_search(query_embeddings: np.ndarray, k: int) -> List[int]:
+    """One batched FAISS search for all query variants, merged with reciprocal-rank fusion"""
+    vectors = np.array(query_embeddings, dtype=np.float32)
+    if db._normalize_L2:
+        faiss.normalize_L2(vectors)
+    _, ids = db.index.search(vectors, k)
+
+    fused: Dict[int, float] = {}
+    for row in ids:
+        for rank, i in enumerate(row.tolist()):
+            if i >= 0:
+                fused[i] = fused.get(i, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)[:k]
+
+def retrieve(query_embeddings: np.ndarray) -> List[int]:
+    """Index ids of the chunks to put in the prompt: a wide ANN candidate set narrowed by MMR"""
+    candidate_ids = fused_search(query_embeddings, FETCH_K)
+    if len(candidate_ids) <= TOP_K:
+        return candidate_ids
+    candidate_vectors = np.vstack([db.index.reconstruct(i) for i in candidate_ids])
+    selected = maximal_marginal_relevance(query_embeddings[0], candidate_vectors, lambda_mult=MMR_LAMBDA, k=TOP_K)
+    return [candidate_ids[j] for j in selected]
 
-def rewrite_question_with_history(question: str, history: Optional[List[dict]]) -> str:
-    if not history:
-        return question
-    # Simple heuristic rewriter: append prior QA context to bias retrieval
-    recent_turns = []
-    for msg in history[-6:]:
-        role = msg.get("role")
-        content = msg.get("content", "")
-        if role in ("user", "assistant") and content:
-            recent_turns.append(f"{role}: {content}")
-    history_hint = " | ".join(recent_turns)
-    return f"[Follow-up based on: {history_hint}] {question}"
+def lookup_docs(ids: List[int]) -> List:
+    return [db.docstore.search(db.index_to_docstore_id[i]) for i in ids]
 
+@lru_cache(maxsize=256)
+def render_context(chunk_ids: Tuple[str, ...]) -> str:
+    # Chunks are immutable once indexed, so the same top-k always renders the same context
+    return "\n\n".join(d.page_content for d in lookup_docs([CHUNK_ROWS[c] for c in chunk_ids]))
+
+@lru_cache(maxsize=1)
+def _metrics_encoding():
+    import tiktoken
+
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+def _truncate_for_metrics(text: str, limit: int = METRICS_DOC_CHAR_LIMIT) -> str:
+    if len(text) <= limit:
+        return text
+    # Drop the last token of the cut so the judges never see half a word
+    encoding = _metrics_encoding()
+    return encoding.decode(encoding.encode(text[:limit])[:-1])
+
+def _docs_for_metrics(answer: str, retrieved_docs: List) -> List:
+    """Only the chunks the answer draws on, trimmed: the judges' token cost scales with context"""
+    used_docs = [
+        d for d in retrieved_docs
+        if (d.metadata.get("school") and d.metadata["school"] in answer)
+        or (d.metadata.get("source") and d.metadata["source"] in answer)
+        or d.page_content[:80] in answer
+    ]
+    return [
+        Document(page_content=_truncate_for_metrics(d.page_content), metadata=d.metadata)
+        for d in (used_docs or retrieved_docs[:TOP_K])
+    ]
+
+def _run_metrics(query: str, answer: str, retrieved_docs: List):
+    try:
+        logger.info("Starting async metrics collection for query: %s", query)
+        metrics_collector = get_collector()
+        rag_metrics = metrics_collector.collect_rag_metrics(query, answer, _docs_for_metrics(answer, retrieved_docs))
+        metrics_collector.save_metrics(rag_metrics, "rag")
+        logger.info("Completed async metrics collection for query: %s", query)
+    except Exception:
+        logger.exception("Error in async metrics collection")
+
+def _should_force_collect(answer: str, retrieved_docs: List) -> bool:
+    # Keep the low-quality tail fully instrumented: hedged answers and thin retrieval
+    if len(retrieved_docs) < TOP_K:
+        return True
+    lowered = answer.lower()
+    return any(marker in lowered for marker in _WEAK_ANSWER_MARKERS)
 
 def collect_metrics_async(query: str, answer: str, retrieved_docs: List):
-    """Collect metrics in a separate thread to avoid blocking the response"""
-    def run_metrics():
-        try:
-            print(f"Starting async metrics collection for query: {query[:50]}...")
-            metrics_collector = RAGASMetricsCollector()
-            rag_metrics = metrics_collector.collect_rag_metrics(query, answer, retrieved_docs)
-            metrics_collector.save_metrics(rag_metrics, "rag")
-            print(f"Completed async metrics collection for query: {query[:50]}")
-        except Exception as e:
-            print(f"Error in async metrics collection: {e}")
-    
-    # Start metrics collection in background thread
-    thread = threading.Thread(target=run_metrics)
-    thread.daemon = True  # Thread will exit when main program exits
-    thread.start()
-
-def query_rag(query: str, history: Optional[List[dict]] = None):
-    expanded_query = rewrite_question_with_history(query, history)
-    result = qa_chain.invoke({"query": expanded_query})
-    answer = result["result"]
-    retrieved_docs = result.get("source_documents", [])
+    """Queue metrics collection on the background pool to avoid blocking the response"""
+    if random.random() >= METRICS_SAMPLE_RATE and not _should_force_collect(answer, retrieved_docs):
+        return
+    if not submit_metrics(_run_metrics, query, answer, retrieved_docs):
+        logger.warning("Metrics queue full, skipping metrics for query: %s", query)
+
+async def _generate_answer(query: str, queries: List[str], scope: str) -> AsyncIterator[str]:
+    """Answer tokens as the LLM produces them; cache insert and metrics run once the answer is complete"""
+    expanded_query = queries[0]
+
+    # Embedded once: the same vectors drive the cache lookup and the FAISS search.
+    # Paraphrased repeats are answered from the cache without retrieval or LLM calls. The cache
+    # compares bare questions only, within the exact history (scope) they were asked in: the
+    # history-prefixed query is dominated by the shared history and would match any follow-up
+    query_embeddings = await embed_queries(tuple(queries))
+    question_row = queries.index(query)
+    cached_answer, retrieved_docs, context = await asyncio.to_thread(
+        lookup_or_retrieve, query_embeddings, question_row, scope
+    )
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    parts = []
+    if USE_LEGACY_CHAIN:
+        result = await qa_chain.ainvoke({"query": expanded_query})
+        parts.append(result["result"])
+        retrieved_docs = result.get("source_documents", [])
+        yield result["result"]
+    else:
+        async for chunk in llm.astream(prompt.format(context=context, question=expanded_query)):
+            parts.append(chunk.content)
+            yield chunk.content
+
+    # Only reached when the caller consumed the whole stream, so partial answers are never cached
+    answer = "".join(parts)
+    await asyncio.to_thread(store_answer, query_embeddings[question_row], query, answer, scope)
     
     # Start metrics collection asynchronously (non-blocking)
     collect_metrics_async(query, answer, retrieved_docs)
-    
-    return answer
\ No newline at end of file
+
+async def _answer_query(query: str, queries: List[str], scope: str) -> str:
+    return "".join([token async for token in _generate_answer(query, queries, scope)])
+
+async def aquery_rag(query: str, history: Optional[List[dict]] = None) -> str:
+    _claim_loop()
+    queries = expand_queries(query, history)
+    expanded_query = queries[0]
+
+    # Identical queries already in flight share that computation instead of repeating it
+    # Waiters need no timeout of their own: the leader always settles the future, bounded by the
+    # LLM's timeout and retries. shield keeps a cancelled waiter from cancelling the leader
+    key = request_key(expanded_query)
+    while (pending := _INFLIGHT.get(key)) is not None:
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            # The leader was cancelled (its client went away), not us: compute it ourselves
+
+    future = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = future
+    try:
+        answer = await _answer_query(query, queries, history_hint(history))
+    except BaseException as exc:
+        if isinstance(exc, Exception):
+            future.set_exception(exc)
+            future.exception()  # mark retrieved so an unwaited failure is not logged twice
+        else:
+            future.cancel()
+        raise
+    else:
+        future.set_result(answer)
+    finally:
+        _INFLIGHT.pop(key, None)
+
+    return answer
+
+def query_rag(query: str, history: Optional[List[dict]] = None) -> str:
+    """Blocking wrapper for scripts and other sync callers; async code should await aquery_rag"""
+    global _sync_loop
+    # One private loop reused across calls: the LLM's pooled async connections are bound to the
+    # loop that opened them, so a fresh asyncio.run() per call would strand them. If a server loop
+    # already owns the module state, aquery_rag refuses to run here instead of sharing it
+    with _sync_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+        return _sync_loop.run_until_complete(aquery_rag(query, history))
+
+async def stream_rag(query: str, history: Optional[List[dict]] = None) -> AsyncIterator[str]:
+    """Same pipeline as aquery_rag, but yields answer tokens as the LLM produces them"""
+    _claim_loop()
+    async for token in _generate_answer(query, expand_queries(query, history), history_hint(history)):
+        yield token
+
+async def warmup():
+    """Prime the embedding client, FAISS index and LLM connection pool before the first user query"""
+    try:
+        _claim_loop()
+        query_embeddings = await embed_queries(("ping",))
+        await asyncio.to_thread(retrieve, query_embeddings)
+        await llm.ainvoke("hi", max_tokens=1)
+        logger.info("RAG warmup complete")
+    except Exception:
+        logger.exception("RAG warmup failed")
@@ -0,0 +1,196 @@
+import os
+import time
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional
+
+class CacheBackend(ABC):
+    """Answer cache keyed by question embedding: near-duplicate questions reuse a prior answer.
+
+    scope partitions entries by exact match (the conversation history a follow-up depends on):
+    similarity only decides between entries of the same scope.
+    """
+
+    threshold: float
+
+    @abstractmethod
+    def search(self, embedding, threshold: Optional[float] = None, scope: str = "") -> Optional[str]:
+        """Return the answer of the most similar fresh entry in scope, if similar enough"""
+
+    @abstractmethod
+    def insert(self, embedding, question: str, answer: str, scope: str = ""):
+        """Cache answer for question under scope"""
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _key(question: str, scope: str = "") -> str:
+        return hashlib.sha256(f"{scope}\0{question}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _scope_id(scope: str) -> int:
+        # 0 is the unscoped (no history) partition
+        return int(hashlib.sha256(scope.encode("utf-8")).hexdigest()[:16], 16) if scope else 0
+
+class SemanticCache(CacheBackend):
+    """In-process LRU cache; lost on restart and private to each worker"""
+
+    def __init__(
+        self,
+        threshold: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        max_size: int = int(os.getenv("SEMANTIC_CACHE_MAX_SIZE", "2000")),
+        ttl: float = float(os.getenv("SEMANTIC_CACHE_TTL", "600")),
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (row in _matrix, answer, created_at); order is least to most recently used
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._matrix: Optional[np.ndarray] = None  # (max_size, D) unit vectors, allocated on first insert
+        self._occupied = np.zeros(max_size, dtype=bool)
+        self._row_keys: List[Optional[str]] = [None] * max_size
+        self._row_scopes = np.zeros(max_size, dtype=np.uint64)
+        self._free_rows = list(range(max_size - 1, -1, -1))
+        self._lock = threading.RLock()
+
+    def _remove(self, key: str):
+        row, _, _ = self._entries.pop(key)
+        self._occupied[row] = False
+        self._row_keys[row] = None
+        self._free_rows.append(row)
+
+    def search(self, embedding, threshold: Optional[float] = None, scope: str = "") -> Optional[str]:
+        """Return the cached answer of the most similar prior question, if similar enough and fresh"""
+        threshold = self.threshold if threshold is None else threshold
+        query = self._normalize(embedding)
+        scope_id = np.uint64(self._scope_id(scope))
+
+        with self._lock:
+            if not self._entries:
+                return None
+
+            # Rows and query are unit vectors, so one matrix-vector product gives every cosine
+            sims = self._matrix @ query
+            sims[~self._occupied | (self._row_scopes != scope_id)] = -np.inf
+            row = int(np.argmax(sims))
+            if sims[row] < threshold:
+                return None
+
+            key = self._row_keys[row]
+            _, answer, created_at = self._entries[key]
+            if time.time() - created_at > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return answer
+
+    def insert(self, embedding, question: str, answer: str, scope: str = ""):
+        vector = self._normalize(embedding)
+        key = self._key(question, scope)
+
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+
+            if key in self._entries:
+                self._remove(key)
+            elif not self._free_rows:
+                # Full: evict the least recently used entry
+                self._remove(next(iter(self._entries)))
+
+            row = self._free_rows.pop()
+            self._matrix[row] = vector
+            self._occupied[row] = True
+            self._row_keys[row] = key
+            self._row_scopes[row] = self._scope_id(scope)
+            self._entries[key] = (row, answer, time.time())
+
+class RedisBackend(CacheBackend):
+    """Cache shared by all workers and kept across restarts: float16 embeddings and answers in Redis,
+    cosine search done client-side over the most recently used entries"""
+
+    def __init__(
+        self,
+        url: str,
+        threshold: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        max_size: int = int(os.getenv("SEMANTIC_CACHE_MAX_SIZE", "2000")),
+        ttl: float = float(os.getenv("SEMANTIC_CACHE_TTL", "600")),
+        window: int = int(os.getenv("SEMANTIC_CACHE_WINDOW", "256")),
+        prefix: str = "rag:cache",
+    ):
+        import redis  # only needed when RAG_CACHE_BACKEND points at Redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.window = window
+        # ZSET of entry keys scored by last use; payloads live in plain keys that expire after ttl
+        self.index_key = f"{prefix}:index"
+        self.prefix = prefix
+
+    def _index_key(self, scope: str) -> str:
+        # One ZSET per scope, so a follow-up only ever competes with entries of the same history
+        return f"{self.index_key}:{self._scope_id(scope):016x}" if scope else self.index_key
+
+    def search(self, embedding, threshold: Optional[float] = None, scope: str = "") -> Optional[str]:
+        threshold = self.threshold if threshold is None else threshold
+        query = self._normalize(embedding)
+        index_key = self._index_key(scope)
+
+        keys = [k.decode() for k in self.redis.zrevrange(index_key, 0, self.window - 1)]
+        if not keys:
+            return None
+        blobs = self.redis.mget([f"{self.prefix}:emb:{k}" for k in keys])
+
+        # Expired payloads (and entries from an index of another dimension) are skipped and unindexed
+        live = [(k, b) for k, b in zip(keys, blobs) if b is not None and len(b) == query.size * 2]
+        stale = [k for k, b in zip(keys, blobs) if b is None or len(b) != query.size * 2]
+        if stale:
+            self.redis.zrem(index_key, *stale)
+        if not live:
+            return None
+
+        matrix = np.frombuffer(b"".join(b for _, b in live), dtype=np.float16).reshape(len(live), -1)
+        sims = matrix.astype(np.float32) @ query
+        row = int(np.argmax(sims))
+        if sims[row] < threshold:
+            return None
+
+        key = live[row][0]
+        answer = self.redis.get(f"{self.prefix}:ans:{key}")
+        if answer is None:
+            return None
+        self.redis.zadd(index_key, {key: time.time()})
+        return answer.decode("utf-8")
+
+    def insert(self, embedding, question: str, answer: str, scope: str = ""):
+        vector = self._normalize(embedding).astype(np.float16)
+        key = self._key(question, scope)
+        index_key = self._index_key(scope)
+        ttl = max(1, int(self.ttl))
+
+        pipe = self.redis.pipeline()
+        pipe.set(f"{self.prefix}:emb:{key}", vector.tobytes(), ex=ttl)
+        pipe.set(f"{self.prefix}:ans:{key}", answer.encode("utf-8"), ex=ttl)
+        pipe.zadd(index_key, {key: time.time()})
+        # Keep only the max_size most recently used entries indexed
+        pipe.zremrangebyrank(index_key, 0, -self.max_size - 1)
+        if scope:
+            # Per-conversation indexes go away once their entries can no longer be served
+            pipe.expire(index_key, ttl)
+        pipe.execute()
+
+def make_cache() -> CacheBackend:
+    """RAG_CACHE_BACKEND=redis://host:port/db shares the cache across workers; otherwise stay in-process"""
+    url = os.getenv("RAG_CACHE_BACKEND", "memory")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    return SemanticCache()
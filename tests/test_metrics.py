@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+import metrics
+
+
+class _Result:
+    scores = [{"faithfulness": 0.9, "answer_relevancy": 0.7}]
+
+
+class _Dataset:
+    @staticmethod
+    def from_dict(data):
+        return data
+
+
+def _stub_evaluate(result):
+    def evaluate(dataset, metrics, raise_exceptions=False):
+        assert raise_exceptions
+        return result() if callable(result) else result
+    return evaluate
+
+
+@pytest.fixture
+def stub_ragas(monkeypatch):
+    monkeypatch.setattr(metrics, "_ragas", (_stub_evaluate(_Result), object(), object(), _Dataset))
+
+
+def test_tokenize_hashes_words():
+    ids = metrics._tokenize("AI policy ai POLICY", limit=3)
+    assert ids.dtype == np.uint32
+    assert len(ids) == 3
+    assert ids[0] == ids[2]
+    assert ids[0] != ids[1]
+
+
+def test_evaluate_with_ragas_scores_context(stub_ragas):
+    collector = metrics.RAGASMetricsCollector()
+    scores = collector.evaluate_with_ragas(
+        "What is the AI policy at ETH Zurich?",
+        "ETH Zurich allows AI tools with disclosure.",
+        ["ETH Zurich AI policy allows tools with disclosure."],
+    )
+    assert scores["faithfulness"] == 0.9
+    assert scores["answer_relevancy"] == 0.7
+    assert 0.0 < scores["context_precision"] <= 1.0
+    assert scores["ragas_score"] != 0.5
+
+
+class _Doc:
+    page_content = "ETH Zurich AI policy allows tools with disclosure."
+
+
+class _Judge:
+    def __init__(self, reply):
+        self.reply = reply
+
+    def invoke(self, prompt):
+        return type("Response", (), {"content": self.reply})()
+
+
+def test_llm_judges_are_off_by_default(stub_ragas):
+    collector = metrics.RAGASMetricsCollector()
+    assert collector.llm is None
+    record = collector.collect_rag_metrics("What is the ETH Zurich policy?", "Disclose AI use.", [_Doc()])
+    assert "llm_judge" not in record
+
+
+def test_llm_judges_are_summarized_when_enabled(stub_ragas, tmp_path):
+    collector = metrics.RAGASMetricsCollector()
+    collector.metrics_file = str(tmp_path / "metrics.jsonl")
+    collector.llm = _Judge("1")
+    collector.save_metrics(collector.collect_rag_metrics("What is the ETH Zurich policy?", "Disclose AI use.", [_Doc()]), "rag")
+    collector.llm = None
+    collector.save_metrics(collector.collect_rag_metrics("Another question?", "Another answer.", [_Doc()]), "rag")
+
+    summary = collector.get_metrics_summary()["rag"]
+    assert summary["total_queries"] == 2
+    assert summary["judged_queries"] == 1
+    assert summary["avg_judge_faithfulness"] == 1.0
+    assert summary["hallucination_rate"] == 1.0
+
+
+def test_nan_ragas_scores_fall_back_and_are_not_cached(monkeypatch):
+    results = iter([
+        type("Failed", (), {"scores": [{"faithfulness": float("nan"), "answer_relevancy": 0.7}]})(),
+        _Result(),
+    ])
+    monkeypatch.setattr(metrics, "_ragas", (_stub_evaluate(lambda: next(results)), object(), object(), _Dataset))
+    collector = metrics.RAGASMetricsCollector()
+    args = ("What is the AI policy?", "Disclose AI use.", ["AI policy: disclose AI use."])
+
+    assert collector.evaluate_with_ragas(*args)["ragas_score"] == 0.5
+    assert collector.evaluate_with_ragas(*args)["faithfulness"] == 0.9
+
+
+def test_submit_metrics_drops_work_beyond_the_queue_limit(monkeypatch):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(metrics, "_METRICS_POOL", pool)
+    monkeypatch.setattr(metrics, "METRICS_QUEUE_LIMIT", 2)
+    release, started = threading.Event(), threading.Event()
+    ran = []
+
+    def busy():
+        started.set()
+        release.wait()
+
+    assert metrics.submit_metrics(busy)
+    started.wait()
+    accepted = [metrics.submit_metrics(ran.append, i) for i in range(4)]
+    release.set()
+    pool.shutdown(wait=True)
+
+    assert accepted == [True, True, False, False]
+    assert ran == [0, 1]
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+import rag_query
+
+
+@pytest.fixture
+def slow_answer(monkeypatch):
+    """Replace the pipeline with a counted, slow stub so only the in-flight dedup logic runs"""
+    calls = []
+
+    async def answer(query, queries, scope):
+        calls.append(query)
+        await asyncio.sleep(0.05)
+        if query.startswith("fail"):
+            raise RuntimeError("upstream error")
+        return f"answer to {query}"
+
+    monkeypatch.setattr(rag_query, "_answer_query", answer)
+    return calls
+
+
+def test_concurrent_identical_queries_share_one_computation(slow_answer):
+    async def run():
+        return await asyncio.gather(*[rag_query.aquery_rag("same question?") for _ in range(5)])
+
+    assert asyncio.run(run()) == ["answer to same question?"] * 5
+    assert slow_answer == ["same question?"]
+    assert not rag_query._INFLIGHT
+
+
+def test_leader_failure_reaches_every_waiter(slow_answer):
+    async def run():
+        return await asyncio.gather(*[rag_query.aquery_rag("fail?") for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert slow_answer == ["fail?"]
+    assert not rag_query._INFLIGHT
+
+    # Failures are not remembered: the next call computes again
+    with pytest.raises(RuntimeError):
+        asyncio.run(rag_query.aquery_rag("fail?"))
+    assert slow_answer == ["fail?", "fail?"]
+
+
+def test_cancelled_leader_hands_over_to_a_waiter(slow_answer):
+    async def run():
+        leader = asyncio.create_task(rag_query.aquery_rag("question?"))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(rag_query.aquery_rag("question?")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.gather(*waiters), leader.cancelled()
+
+    answers, leader_cancelled = asyncio.run(run())
+    assert leader_cancelled
+    assert answers == ["answer to question?"] * 3
+    assert slow_answer == ["question?", "question?"]
+    assert not rag_query._INFLIGHT
+
+
+def test_cancelled_waiter_leaves_the_leader_running(slow_answer):
+    async def run():
+        leader = asyncio.create_task(rag_query.aquery_rag("question?"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(rag_query.aquery_rag("question?"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        return await leader, waiter.cancelled()
+
+    assert asyncio.run(run()) == ("answer to question?", True)
+    assert slow_answer == ["question?"]
+
+
+def test_sync_wrapper_refuses_a_loop_serving_the_async_api(slow_answer):
+    import threading
+
+    server_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=server_loop.run_forever)
+    thread.start()
+    try:
+        served = asyncio.run_coroutine_threadsafe(rag_query.aquery_rag("served?"), server_loop).result()
+        assert served == "answer to served?"
+        with pytest.raises(RuntimeError, match="another event loop"):
+            rag_query.query_rag("script?")
+    finally:
+        server_loop.call_soon_threadsafe(server_loop.stop)
+        thread.join()
+        server_loop.close()
+
+    # Once the server loop is gone, the sync wrapper can take over
+    assert rag_query.query_rag("script?") == "answer to script?"
+    rag_query._sync_loop.close()
+    rag_query._sync_loop = None
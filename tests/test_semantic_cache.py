@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from semantic_cache import CacheBackend, RedisBackend, SemanticCache
+
+HISTORY = "user: What is the AI policy at ETH Zurich? | assistant: ETH Zurich allows AI tools with disclosure."
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = pytest.importorskip("redis")
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", classmethod(lambda cls, url: fakeredis.FakeRedis(server=server)))
+    return RedisBackend("redis://test", max_size=8)
+
+
+def _vector(seed):
+    return np.random.default_rng(seed).standard_normal(32)
+
+
+def _exercise(cache):
+    japan, students = _vector(1), _vector(2)
+    cache.insert(japan, "What about Japan?", "japan answer", scope=HISTORY)
+
+    assert cache.search(japan + 0.01, scope=HISTORY) == "japan answer"
+    # Same history, different follow-up
+    assert cache.search(students, scope=HISTORY) is None
+    # Same question without (or with another) history
+    assert cache.search(japan) is None
+    assert cache.search(japan, scope="user: hi") is None
+
+
+def test_in_memory_cache_scopes_by_history():
+    _exercise(SemanticCache(max_size=8))
+
+
+def test_redis_cache_scopes_by_history(redis_cache):
+    _exercise(redis_cache)
+
+
+def test_redis_cache_unindexes_other_dimensions(redis_cache):
+    cache = redis_cache
+    cache.insert(np.ones(16), "old model", "old answer")
+    cache.insert(_vector(1), "new model", "new answer")
+    assert cache.search(_vector(1)) == "new answer"
+    assert cache.redis.zcard(cache.index_key) == 1
+
+
+def test_cache_backend_is_abstract():
+    with pytest.raises(TypeError):
+        CacheBackend()